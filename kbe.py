@@ -1,102 +1,247 @@
 #!/usr/bin/python3
 
+import argparse
+import asyncio
 import json
-import sys
 import os
-from datetime import datetime
-
-conv_name = sys.argv[1]
-conv_dir = "./" + conv_name
-os.mkdir(conv_dir)
-
-pg = 1000
-query = '{"method": "read", "params": {"options": {"channel": {"name": "' + conv_name + '", "pagination": {"num": ' + str(pg) + '}}}}}'
-
-json_out = conv_dir + "/out.json"
-log_out = conv_dir + "/conv.log"
-
-def run_query(q):
-    cmd = "keybase chat api -m '" + query + "' >" + json_out
-    os.system(cmd)
-
-run_query(query)
-
-query_dl = []
-
-def get_content_type(entry):
-    return entry["msg"]["content"]["type"]
-
-def get_sender(entry):
-    return entry["msg"]["sender"]["username"]
-
-def get_msg_id(entry):
-    return str(entry["msg"]["id"])
-
-def get_filename(entry):
-    ctype = get_content_type(entry)
+from array import array
+from time import gmtime, strftime
+
+try:
+    import orjson as _json       # C extension, much faster on big pages
+except ImportError:
+    _json = json
+
+async def run_query_async(q):
+    # stderr is left on the terminal; capturing it via communicate() would
+    # buffer and copy both streams before we could look at the response
+    proc = await asyncio.create_subprocess_exec(
+        "keybase", "chat", "api", "-m", q,
+        stdout=asyncio.subprocess.PIPE)
+    stdout = await proc.stdout.read()
+    if await proc.wait() != 0:
+        print("keybase chat api failed")
+        exit(1)
+    return stdout
+
+class KeybaseClient:
+    # one long-lived "keybase chat api" process; queries go down stdin as
+    # JSON lines and each response comes back as one line, so pagination
+    # pays fork+exec+Go-runtime startup once instead of per page
+    def __init__(self):
+        self.proc = None
+
+    async def call(self, q):
+        if self.proc is None:
+            # a full page response is one line and can run to megabytes;
+            # the StreamReader default limit of 64 KiB would make
+            # readline() blow up on it
+            self.proc = await asyncio.create_subprocess_exec(
+                "keybase", "chat", "api",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=1 << 26)
+        self.proc.stdin.write(q.encode() + b"\n")
+        await self.proc.stdin.drain()
+        out = await self.proc.stdout.readline()
+        if not out:
+            print("keybase chat api exited unexpectedly")
+            exit(1)
+        return out
+
+    async def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            await self.proc.wait()
+
+async def download_attachment(f, q):
+    async with dl_sem:
+        print("downloading " + f)
+        await run_query_async(q)
+
+def get_filename(content, ctype):
     if ctype == "attachment":
-        return entry["msg"]["content"]["attachment"]["object"]["filename"]
+        return content["attachment"]["object"]["filename"]
     elif ctype == "attachmentuploaded":
-        return entry["msg"]["content"]["attachment_uploaded"]["object"]["filename"]
+        return content["attachment_uploaded"]["object"]["filename"]
     else:
         print("don't know how to get filename")
         exit(1)
 
-def mk_out_filename(entry):
-    return conv_dir + "/msg_id_" + get_msg_id(entry) + "_" + get_filename(entry)
-
-msg_stack = list()
-
-def outputmsgs():
-    with open(json_out, 'r') as f:
-        outputmsgs.json_data = json.load(f)
-    for entry in outputmsgs.json_data["result"]["messages"]:
-        out = ""
-        ctype = get_content_type(entry)
-        mid = get_msg_id(entry)
-        content = entry["msg"]["content"]
-        sent_at = entry["msg"]["sent_at"]
-        if ctype == "text":
-            out = "<" + get_sender(entry) + "> " + content["text"]["body"]
-        elif ctype == "reaction":
-            out = "* " + get_sender(entry) + ": " + content["reaction"]["b"]
+# path separators and NULs in a sender-chosen filename must not escape
+# the export directory or corrupt the output path
+_SLASH = str.maketrans({'/': '_', '\\': '_', '\x00': '_'})
+
+def mk_out_filename(mid, content, ctype):
+    return conv_dir + "/msg_id_" + mid + "_" + get_filename(content, ctype).translate(_SLASH)
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+
+DL_CHUNK = 32
+
+# formatters for message types that need no I/O, keyed by content type;
+# attachments are handled separately since they schedule downloads
+FORMATTERS = {
+    "text": lambda mid, content, sender:
+        f"<{sender}> {content['text']['body']}",
+    "reaction": lambda mid, content, sender:
+        f"* {sender}: {content['reaction']['b']}",
+    "attachmentuploaded": lambda mid, content, sender:
+        f"{sender} attachment {mk_out_filename(mid, content, 'attachmentuploaded')} uploaded",
+    "edit": lambda mid, content, sender:
+        f"{sender} edited message with id {content['edit']['messageID']} to: {content['edit']['body']}",
+    "delete": lambda mid, content, sender:
+        f"{sender} deleted message with ids [{', '.join(map(str, content['delete']['messageIDs']))}]",
+    "unfurl": lambda mid, content, sender:
+        f"{sender} sent unfurl: {content['unfurl']['unfurl']['url']}",
+}
+
+# some servers hand back overlapping pages under distinct cursors, so halting
+# on the cursor alone is not enough; track every message id we have written
+seen_mids = set()
+
+# pending downloads as parallel columns rather than a list of tuples;
+# the array of ids costs 8 bytes per entry instead of a tuple object
+dl_mids = array('q')
+dl_names = []
+
+def outputmsgs(json_data):
+    lines = []
+    # keep the hot loop on LOAD_FAST: bind the names it hits per message
+    append = lines.append
+    seen = seen_mids
+    seen_add = seen_mids.add
+    formatters_get = FORMATTERS.get
+    for entry in json_data["result"]["messages"]:
+        msg = entry["msg"]
+        if msg["id"] in seen:
+            continue
+        seen_add(msg["id"])
+        content = msg["content"]
+        ctype = content["type"]
+        mid = str(msg["id"])
+        sender = msg["sender"]["username"]
+        sent_at = msg["sent_at"]
+        fmt = formatters_get(ctype)
+        if fmt is not None:
+            out = fmt(mid, content, sender)
         elif ctype == "attachment":
-            file_name = mk_out_filename(entry)
-            out = get_sender(entry) + " sent attachment " + file_name
-            query = '{"method": "download", "params": {"options": {"channel": {"name": "' + conv_name + '"}, "message_id": ' + mid + ', "output": "' + file_name + '"}}}'
-            query_dl.append((file_name, query))
-        elif ctype == "attachmentuploaded":
-            out = get_sender(entry) + " attachment " + mk_out_filename(entry) + " uploaded"
-        elif ctype == "edit":
-            edit = content["edit"]
-            out = get_sender(entry) + " edited message with id " + str(edit["messageID"]) + " to: " + edit["body"]
-        elif ctype == "delete":
-            out = get_sender(entry) + " deleted message with ids " + str(content["delete"]["messageIDs"])
-        elif ctype == "unfurl":
-            out = get_sender(entry) + " sent unfurl: " + str(content["unfurl"]["unfurl"]["url"])
+            file_name = mk_out_filename(mid, content, ctype)
+            out = sender + " sent attachment " + file_name
+            base = os.path.basename(file_name)
+            if base not in existing:
+                existing.add(base)
+                dl_mids.append(msg["id"])
+                dl_names.append(file_name)
         else:
             out = "(unknown message type '" + ctype + "')"
             # print(entry)
-        msg_stack.append("#" + mid + " - " + datetime.utcfromtimestamp(sent_at).strftime('%Y-%m-%d %H:%M:%S') + " - " + out + '\n')
-    res = "next" in outputmsgs.json_data["result"]["pagination"]
-    if res:
-       outputmsgs.next = outputmsgs.json_data["result"]["pagination"]["next"]
-    return res
-
-print("exporting messages...")
-
-while outputmsgs():
-    query = '{"method": "read", "params": {"options": {"channel": {"name": "' + conv_name + '"}, "pagination": {"next": "' + outputmsgs.next + '", "num": ' + str(pg) + '}}}}'
-    run_query(query)
-
-with open(log_out, 'a') as outfile:
-    while msg_stack:
-        msg = msg_stack.pop()
-        outfile.write(msg)
-
-print("downloading attachments...")
-
-for (f, q) in query_dl:
-    print("downloading " + f)
-    cmd = "keybase chat api -m '" + q + "' > /dev/null"
-    os.system(cmd)
+        append("#" + mid + " - " + strftime(TIME_FMT, gmtime(sent_at)) + " - " + out + '\n')
+    return lines
+
+async def producer(page_q, stop, client):
+    # the raw response bytes go to disk untouched, one JSON document per
+    # line -- no parse-then-re-serialize round trip
+    json_f = open(json_out, 'wb') if args.save_json else None
+    query = READ_TMPL
+    while True:
+        out = await client.call(query)
+        if json_f is not None:
+            json_f.write(out)
+        json_data = _json.loads(out)
+        await page_q.put(json_data)
+        pagination = json_data["result"]["pagination"]
+        if "next" not in pagination or stop.is_set():
+            break
+        query = READ_NEXT_TMPL.replace('"__NEXT__"', json.dumps(pagination["next"]))
+    if json_f is not None:
+        json_f.close()
+    await page_q.put(None)
+
+async def consumer(page_q, all_pages, stop):
+    while True:
+        json_data = await page_q.get()
+        if json_data is None:
+            break
+        lines = outputmsgs(json_data)
+        if not lines and json_data["result"]["messages"]:
+            # a full page of already-seen messages: pagination is looping
+            stop.set()
+            continue
+        all_pages.append(lines)
+
+async def export():
+    print("exporting messages...")
+
+    page_q = asyncio.Queue(2)
+    all_pages = []
+    stop = asyncio.Event()
+    client = KeybaseClient()
+    await asyncio.gather(producer(page_q, stop, client),
+                         consumer(page_q, all_pages, stop))
+    await client.close()
+
+    # keybase returns newest first, both within a page and page to page,
+    # so reversing both levels yields chronological order
+    with open(log_out, 'wb') as outfile:
+        outfile.write("".join(line for page in reversed(all_pages)
+                              for line in reversed(page)).encode())
+
+    print("downloading attachments...")
+
+    # dispatch in chunks; there is no batch download verb in the keybase
+    # api yet, so each chunk fans out one query per attachment
+    for i in range(0, len(dl_names), DL_CHUNK):
+        await asyncio.gather(
+            *(download_attachment(f, DL_TMPL.replace('"__MID__"', str(m))
+                                  .replace('"__OUT__"', json.dumps(f)))
+              for m, f in zip(dl_mids[i:i + DL_CHUNK],
+                              dl_names[i:i + DL_CHUNK])))
+
+def main():
+    global args, conv_name, conv_dir, existing, pg, dl_sem
+    global READ_TMPL, READ_NEXT_TMPL, DL_TMPL, json_out, log_out
+
+    ap = argparse.ArgumentParser(description="Export a keybase chat conversation")
+    ap.add_argument("conversation", help="conversation (channel) name to export")
+    ap.add_argument("--download-concurrency", type=int,
+                    default=int(os.environ.get("KBE_DL_CONCURRENCY", "5")),
+                    help="max attachment downloads in flight (default 5)")
+    ap.add_argument("--save-json", action="store_true",
+                    help="also save the raw keybase responses to out.json")
+    ap.add_argument("--page-size", type=int,
+                    default=int(os.environ.get("KBE_PG", "1000")),
+                    help="messages fetched per read RPC (default 1000)")
+    args = ap.parse_args()
+
+    conv_name = args.conversation
+    conv_dir = "./" + conv_name
+    os.makedirs(conv_dir, exist_ok=True)
+
+    # one directory scan up front instead of a stat per attachment; lets a
+    # rerun into an existing export directory skip downloads already on disk
+    existing = {e.name for e in os.scandir(conv_dir)}
+
+    pg = args.page_size
+
+    dl_sem = asyncio.Semaphore(args.download_concurrency)
+
+    # query skeletons are dumped once; the varying values are spliced in with
+    # json.dumps so escaping stays correct without re-encoding the whole tree
+    READ_TMPL = json.dumps({"method": "read", "params": {"options": {
+        "channel": {"name": conv_name},
+        "pagination": {"num": pg}}}})
+    READ_NEXT_TMPL = json.dumps({"method": "read", "params": {"options": {
+        "channel": {"name": conv_name},
+        "pagination": {"next": "__NEXT__", "num": pg}}}})
+    DL_TMPL = json.dumps({"method": "download", "params": {"options": {
+        "channel": {"name": conv_name},
+        "message_id": "__MID__", "output": "__OUT__"}}})
+
+    json_out = conv_dir + "/out.json"
+    log_out = conv_dir + "/conv.log"
+
+    asyncio.run(export())
+
+if __name__ == "__main__":
+    main()